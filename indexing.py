@@ -1,13 +1,15 @@
 import os
 import wp
 
-try:
-	os.remove("./data/index3.db")
-except OSError:
-	pass
+if __name__ == "__main__":
+	# guarded so Index.generate's worker processes can re-import this module
+	try:
+		os.remove("./data/index3.db")
+	except OSError:
+		pass
 
-collection = wp.WikipediaCollection("./data/wp.db")
-index = wp.Index("./data/index4.db", collection)
-index.generate()
-index.generate_ngrams()
-index.generateFromOpeningText()
+	collection = wp.WikipediaCollection("./data/wp.db")
+	index = wp.Index("./data/index4.db", collection)
+	index.generate(fts=True)
+	index.generate_ngrams()
+	index.generateFromOpeningText()
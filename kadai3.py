@@ -13,7 +13,7 @@ def action():
    terms = analyse.extractWords(query)
    ngrams = analyse.divide_ngrams(query)
    print('Debug: get document title containing ngrams', index.ngrams_search(ngrams))
-   title = index.sortSearch(terms)
+   title = index.ftsSortSearch(terms)
    bottle.response.content_type = 'application/json'
    if title is None:
        return json.dums({
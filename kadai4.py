@@ -1,15 +1,46 @@
 import bottle
+import functools
 import wp
 import json
 import os
 
 collection = wp.WikipediaCollection("./data/wp.db")
-index = wp.Index("./data/index.db", collection)
+index = wp.Index("./data/index.db", collection, preload=True)
 analyse = wp.AnalyseQuery()
 
 gameEnd = False
 wordsState = []
 
+# /action only reports how many articles match, so only the count is cached
+@functools.lru_cache(maxsize=1024)
+def _cached_count(terms_tuple):
+    return len(index.search(list(terms_tuple)))
+
+def _response(text):
+    return json.dumps({
+        'textToSpeech': text
+    }, indent=2, separators=(',', ': '), ensure_ascii=False)
+
+def _template(text):
+    # serialized once at import; only {count} and {words} are filled in per request
+    body = _response(text).replace('{', '{{').replace('}', '}}')
+    return body.replace('{{count}}', '{count}').replace('{{words}}', '{words}')
+
+def _escape(text):
+    # escape a value for embedding inside a JSON string literal
+    return json.dumps(text, ensure_ascii=False)[1:-1]
+
+RESPONSE_NEW_GAME = _response('新しいゲームを始めるよ。単語を言ってください')
+RESPONSE_RETRY = _response('聞こえないよ？もう一度遊びますか？')
+#しんばる
+#爆発音
+RESPONSE_LOSE = _response('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio><audio src="https://actionproxy-e83f8.firebaseapp.com/pop_explosion.mp3">どっかーん</audio>記事が見つかりませんでした。あなたのまけー！もう一度遊びますか</speak>')
+TEMPLATE_LT5 = _template('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{count}件見つかりました。今まで言われた単語は{words}です。もう爆発寸前ですね。気をつけて！</speak>')
+TEMPLATE_LT10 = _template('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{count}件見つかりました。今まで言われた単語は{words}です。そろそろ爆発しそうですね。どきどきします。</speak>')
+TEMPLATE_LT100 = _template('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{count}件見つかりました。今まで言われた単語は{words}です。もうちょっと攻めてください。</speak>')
+TEMPLATE_LT500 = _template('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{count}件見つかりました。今まで言われた単語は{words}です。もっといけますよ。</speak>')
+TEMPLATE_MANY = _template('<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{count}件見つかりました。今まで言われた単語は{words}です。まだまだですね。</speak>')
+
 @bottle.route('/action')
 def action():
     global wordsState, gameEnd
@@ -18,52 +49,30 @@ def action():
     if gameEnd:
         if query == 'はい':
             gameEnd = False
-            return json.dumps({
-                'textToSpeech': '新しいゲームを始めるよ。単語を言ってください'
-            }, indent=2, separators=(',', ': '), ensure_ascii=False)
+            return RESPONSE_NEW_GAME
         else:
-            return json.dumps({
-                'textToSpeech': '聞こえないよ？もう一度遊びますか？'
-                #'textToSpeech': 'にゃ' #上書きされちゃう
-            }, indent=2, separators=(',', ': '), ensure_ascii=False)
+            return RESPONSE_RETRY
 
 
     terms = analyse.extractWords(query)
     wordsState += terms
-    titles = index.search(wordsState)
-    if len(titles) == 0:
+    count = _cached_count(tuple(sorted(set(wordsState))))
+    if count == 0:
         wordsState = []
         gameEnd = True
-        return json.dumps({
-            #しんばる
-            #爆発音
-            'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio><audio src="https://actionproxy-e83f8.firebaseapp.com/pop_explosion.mp3">どっかーん</audio>記事が見つかりませんでした。あなたのまけー！もう一度遊びますか</speak>'
-            }, indent=2, separators=(',', ': '), ensure_ascii=False)
-
-    if len(titles) < 5:
-        return json.dumps({
-            'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{}件見つかりました。今まで言われた単語は{}です。もう爆発寸前ですね。気をつけて！</speak>'.format(len(titles), 'と'.join(wordsState))
-        }, indent=2, separators=(',', ': '), ensure_ascii=False)
-
-
-    if len(titles) < 10:
-        return json.dumps({
-            'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{}件見つかりました。今まで言われた単語は{}です。そろそろ爆発しそうですね。どきどきします。</speak>'.format(len(titles), 'と'.join(wordsState))
-        }, indent=2, separators=(',', ': '), ensure_ascii=False)
-
-    if len(titles) < 100:
-        return json.dumps({
-            'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{}件見つかりました。今まで言われた単語は{}です。もうちょっと攻めてください。</speak>'.format(len(titles), 'と'.join(wordsState))
-        }, indent=2, separators=(',', ': '), ensure_ascii=False)
- 
-    if len(titles) < 500:
-        return json.dumps({
-            'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{}件見つかりました。今まで言われた単語は{}です。もっといけますよ。</speak>'.format(len(titles), 'と'.join(wordsState))
-        }, indent=2, separators=(',', ': '), ensure_ascii=False)
-    
-    return json.dumps({
-        'textToSpeech': '<speak><audio src="https://actionproxy-e83f8.firebaseapp.com/ranking.mp3">ドラムロール</audio>記事が{}件見つかりました。今まで言われた単語は{}です。まだまだですね。</speak>'.format(len(titles), 'と'.join(wordsState))
-    }, indent=2, separators=(',', ': '), ensure_ascii=False)
+        return RESPONSE_LOSE
+
+    if count < 5:
+        template = TEMPLATE_LT5
+    elif count < 10:
+        template = TEMPLATE_LT10
+    elif count < 100:
+        template = TEMPLATE_LT100
+    elif count < 500:
+        template = TEMPLATE_LT500
+    else:
+        template = TEMPLATE_MANY
+    return template.format(count=count, words=_escape('と'.join(wordsState)))
 
 
 @bottle.route('/article/<title>')
@@ -1,12 +1,22 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
 import sqlite3
 import sys
 import json
 import natto
 import math
+import os
 import numpy
 import unicodedata
 import string
-import re
+import threading
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 class Document():
     """Abstract class representing a document.
@@ -63,18 +73,42 @@ class WikipediaArticle(Document):
         wiki_text (str): The MediaWiki markdown source.
         popularity_score(float): Some score indicating article popularity. Bigger is more popular.
         num_incoming_links(int): Number of links (within Wikipedia) that point to this article.
+
+    auxiliary_text, categories and headings are passed in as the raw JSON strings from the
+    database and are only parsed on first access.
     """
-    def __init__(self, collection, title, text, opening_text, auxiliary_text, categories, headings, wiki_text, popularity_score, num_incoming_links):
+    def __init__(self, collection, title, text, opening_text, auxiliary_text_json, categories_json, headings_json, wiki_text, popularity_score, num_incoming_links):
         self.title = title
         self._text = text
         self.opening_text = opening_text
-        self.auxiliary_text = auxiliary_text # list
-        self.categories = categories
-        self.headings = headings
+        self._auxiliary_text_json = auxiliary_text_json
+        self._auxiliary_text = None
+        self._categories_json = categories_json
+        self._categories = None
+        self._headings_json = headings_json
+        self._headings = None
         self.wiki_text = wiki_text
         self.popularity_score = popularity_score
         self.num_incoming_links = num_incoming_links
 
+    @property
+    def auxiliary_text(self):
+        if self._auxiliary_text is None:
+            self._auxiliary_text = json.loads(self._auxiliary_text_json)
+        return self._auxiliary_text
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._categories = json.loads(self._categories_json)
+        return self._categories
+
+    @property
+    def headings(self):
+        if self._headings is None:
+            self._headings = json.loads(self._headings_json)
+        return self._headings
+
     def id(self):
         """Returns the id for the WikipediaArticle, which is its title.
 
@@ -95,140 +129,289 @@ class WikipediaArticle(Document):
         """
         return self._text
 
+# characters dropped before splitting text into 2-grams
+_NGRAM_STRIP_CHARS = set(string.punctuation + string.ascii_letters + string.digits + "「」、。・『』《》 ¥“\n\r\t年月日")
+_NGRAM_TABLE = {ord(char): None for char in _NGRAM_STRIP_CHARS}
+
+# (part of speech, sub part of speech) pairs kept by FilterWords.shouldBeIncluded
+_ALLOWED = frozenset({
+    ('名詞', 'サ変接続'),
+    ('名詞', '一般'),
+    ('名詞', '形容動詞語幹'),
+    ('名詞', '固有名詞'),
+    ('名詞', '数'),
+    ('形容詞', '自立'),
+    ('動詞', '自立'),
+})
+
 class FilterWords():
     def shouldBeIncluded(feature):
-        if feature[0] == '名詞':
-            if feature[1] == 'サ変接続' or feature[1] == '一般' or feature[1] == '形容動詞語幹' or feature[1] == '固有名詞' or feature[1] == '数':
-                return True
-        elif feature[0] == '形容詞':
-            if feature[1] == '自立':
-                return True
-        elif feature[0] == '動詞':
-            if feature[1] == '自立':
-                return True
-        return False
+        return (feature[0], feature[1]) in _ALLOWED
 
     def excludeParticles(features):
         return features[0] != '助詞'
 
 class AnalyseQuery():
 
+    def __init__(self):
+        # natto parsers keep per-parse state, so each request thread gets its own, see _parser()
+        self._local = threading.local()
+        # per-instance cache, so it does not keep this object and its parsers alive
+        self._extractWords = functools.lru_cache(maxsize=4096)(self._parseWords)
+
+    def _parser(self):
+        """Returns the MeCab parser for the calling thread, creating it on first use.
+        """
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = natto.MeCab()
+            self._local.parser = parser
+        return parser
+
     def extractWords(self, query, func = FilterWords.shouldBeIncluded):
-        parser = natto.MeCab()
+        # copy so callers can't mutate the cached result
+        return list(self._extractWords(query, func))
+
+    def _parseWords(self, query, func):
         terms = []
-        for node in parser.parse(query, as_nodes=True):
+        for node in self._parser().parse(query, as_nodes=True):
             if node.is_nor():
                 features = node.feature.split(',')
                 # if features[0] != '助詞':
                 if func(features):
                     terms.append(features[6] if len(features) == 9 else node.surface)
-        return terms
+        return tuple(terms)
 
     def divide_ngrams(self, query):
-        n = 2
-        table_for_remove = str.maketrans("", "", string.punctuation  + "「」、。・『』《》")
-        ngrams = unicodedata.normalize("NFKC", query.strip().replace(" ", ""))
-        ngrams = ngrams.translate(table_for_remove)
-        ngrams = re.sub(r'[a-zA-Z0-9¥"¥.¥,¥@]+', '', ngrams, flags=re.IGNORECASE)
-        ngrams = re.sub(r'[!"“#$%&()\*\+\-\.,\/:;<=>?@\[\\\]^_`{|}~]', '', ngrams, flags=re.IGNORECASE)
-        ngrams = re.sub(r'[\n|\r|\t|年|月|日]', '', ngrams, flags=re.IGNORECASE)
+        ngrams = unicodedata.normalize("NFKC", query).translate(_NGRAM_TABLE)
+        # each 2-gram is packed into one integer: (first codepoint << 21) | second codepoint
+        return [(ord(a) << 21) | ord(b) for a, b in zip(ngrams, ngrams[1:])]
+
+def _cosines_numpy(M, v):
+    """Returns the cosine similarity of every row of M (document vectors) to v.
+    """
+    return (M @ v) / (numpy.linalg.norm(M, axis=1) * numpy.linalg.norm(v))
+
+if numba is None:
+    _cosines = _cosines_numpy
+else:
+    @numba.njit(cache=True, fastmath=True)
+    def _cosines(M, v):
+        """Returns the cosine similarity of every row of M (document vectors) to v.
+        """
+        v_norm = 0.0
+        for j in range(v.shape[0]):
+            v_norm += v[j] * v[j]
+        v_norm = math.sqrt(v_norm)
+
+        scores = numpy.empty(M.shape[0], dtype=numpy.float64)
+        for i in range(M.shape[0]):
+            dot = 0.0
+            norm = 0.0
+            for j in range(M.shape[1]):
+                dot += M[i, j] * v[j]
+                norm += M[i, j] * M[i, j]
+            scores[i] = dot / (math.sqrt(norm) * v_norm)
+        return scores
+
+# compile (or load from cache) now rather than on the first request
+_cosines(numpy.ones((1, 1)), numpy.ones(1))
+
+def _count_terms(parser, text):
+    """Parses text with MeCab and counts the terms kept by FilterWords.shouldBeIncluded.
+
+    Returns:
+        Dict[str, int]: Occurrences of each term in text.
+    """
+    dict = {}
+    for node in parser.parse(text, as_nodes=True):
+        if node.is_nor():
+            features = node.feature.split(',')
+            term = features[6] if len(features) == 9 else node.surface
+            if FilterWords.shouldBeIncluded(features):
+                if term in dict:
+                    dict[term] += 1
+                else:
+                    dict[term] = 1
+    return dict
+
+# parser of an indexing worker process, set up by _init_worker
+_worker_parser = None
+
+def _init_worker():
+    global _worker_parser
+    _worker_parser = natto.MeCab()
 
-        ngrams = [ngrams[i:i+n] for i in range(0, len(ngrams))]
-        return ngrams
+def _parse_articles(articles):
+    return [(title, _count_terms(_worker_parser, text)) for title, text in articles]
+
+def _fts_token(term):
+    # hex digits are token characters for unicode61, so a whole MeCab term stays one token
+    return term.encode('utf-8').hex()
 
 class Index():
 
-    def __init__(self, filename, collection):
-        self.db = sqlite3.connect(filename)
+    def __init__(self, filename, collection, preload=False):
+        # autocommit mode: transactions are opened explicitly with BEGIN/COMMIT
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL;")
+        self.db.execute("PRAGMA synchronous=NORMAL;")
+        self.db.execute("PRAGMA temp_store=MEMORY;")
+        self.db.execute("PRAGMA cache_size=-200000;")
+        self.filename = filename
+        # search paths use one read-only connection per thread, see _reader()
+        self._local = threading.local()
         self.collection = collection
+        # term -> frozenset of document ids, used by search() instead of SQL when loaded
+        self._inv = self._loadPostings() if preload else None
+
+    def _loadPostings(self):
+        inv = {}
+        # sqlite returns a new str per row; share one title object per document
+        titles = {}
+        for term, document_id in self._reader().execute("SELECT term, document_id FROM postings"):
+            document_id = titles.setdefault(document_id, document_id)
+            if term in inv:
+                inv[term].add(document_id)
+            else:
+                inv[term] = {document_id}
+        return {term: frozenset(ids) for term, ids in inv.items()}
+
+    def _reader(self):
+        """Returns the read-only connection for the calling thread, opening it on first use.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename)
+            conn.execute("PRAGMA mmap_size=268435456;")
+            conn.execute("PRAGMA cache_size=-100000;")
+            conn.execute("PRAGMA query_only=1;")
+            self._local.conn = conn
+        return conn
 
     def search(self, terms):
-        c = self.db.cursor()
+        c = self._reader().cursor()
 
         # search process
         print("extractWords Done")
 
-        # titles which apeare len(query) times are the rets
-        titles = []
-        flag = True
-        for term in terms:
-            cands = c.execute("SELECT document_id FROM postings WHERE term=?", (term,)).fetchall()
-            if cands == None: # TODO: len(cands) == 0
-                continue
-            """
-            for cand in cands:
-                if cand[0] in dict:
-                    dict[cand[0]] += 1
-                else:
-                    dict[cand[0]] = 1
-                if dict[cand[0]] == len(terms):
-                    titles.append(cand[0])
-            """
-
-            temptitles = set(map(lambda c:c[0], cands))
-
-            if flag:
-                titles = temptitles
-                flag = False
-            else:
-                titles = titles & temptitles
+        # titles which contain every term are the rets
+        terms = list(set(terms))
+        if len(terms) == 0:
+            return []
+        if self._inv is not None:
+            # intersect the in-memory postings, starting from the smallest
+            sets = sorted((self._inv.get(term, frozenset()) for term in terms), key=len)
+            return list(sets[0].intersection(*sets[1:]))
+
+        placeholders = ",".join("?" * len(terms))
+        counts = dict(c.execute(f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term", terms))
+        if len(counts) < len(terms):
+            # a term without postings empties the intersection
+            return []
+
+        # walk the rarest term's postings and probe the index for the others
+        terms.sort(key=counts.get)
+        probes = " AND EXISTS (SELECT 1 FROM postings p WHERE p.term=? AND p.document_id=p0.document_id)" * (len(terms) - 1)
+        c.execute(f"SELECT DISTINCT p0.document_id FROM postings p0 WHERE p0.term=?{probes}", terms)
+        titles = [document_id for (document_id,) in c]
 
         print("all terms searched") 
         return titles
 
     def sortSearch(self, terms):
-        c = self.db.cursor()
+        c = self._reader().cursor()
 
-        documentVectors = {}
+        # document vectors are the rows of one matrix; titles[i] is the title of row i
+        titles = []
+        rows = {}
+        columns = []
         defaultVector = []
         for n, term in enumerate(terms):
-            cands = c.execute("SELECT document_id FROM postings WHERE term=?", (term,)).fetchall()
-            if cands == None or len(cands) ==  0:
+            # stream postings straight off the cursor into row indices
+            indices = []
+            for (document_id,) in c.execute("SELECT DISTINCT document_id FROM postings WHERE term=?", (term,)):
+                if document_id not in rows:
+                    rows[document_id] = len(titles)
+                    titles.append(document_id)
+                indices.append(rows[document_id])
+            if len(indices) == 0:
                 defaultVector.append(0)
                 continue
             # non-zero div is ensured
-            termPoint = (1 + math.log(len(cands)) * math.log(self.collection.num_documents() / len(cands)))
+            termPoint = (1 + math.log(len(indices)) * math.log(self.collection.num_documents() / len(indices)))
             defaultVector.append(termPoint)
+            columns.append((n, indices, termPoint))
 
-            for cand in cands:
-                if cand[0] in documentVectors:
-                    documentVectors[cand[0]][n] = termPoint
-                else:
-                    documentVectors[cand[0]] = [0 for i in range(len(terms))]
-                    documentVectors[cand[0]][n] = termPoint
+        if len(titles) == 0:
+            return ''
+
+        # float64 like the per-document numpy.dot it replaces, so ties resolve the same way
+        M = numpy.zeros((len(titles), len(terms)), dtype=numpy.float64)
+        for n, indices, termPoint in columns:
+            M[indices, n] = termPoint
+        v = numpy.array(defaultVector, dtype=numpy.float64)
 
+        scores = _cosines(M, v)
+
+        # summation order differs from the per-document numpy.dot this replaced, so
+        # rescore the near-best rows that way to pick the same title on (near) ties
         max_cos = -1
         best_title = ''
-
-        for title, documentVector in documentVectors.items():
-            cos = numpy.dot(documentVector, defaultVector) / (numpy.linalg.norm(documentVector) * numpy.linalg.norm(defaultVector))
+        for i in numpy.flatnonzero(scores >= scores.max() - 1e-9):
+            cos = numpy.dot(M[i], v) / (numpy.linalg.norm(M[i]) * numpy.linalg.norm(v))
             if max_cos < cos:
                 max_cos = cos
-                best_title = title
+                best_title = titles[i]
         return best_title
 
     def ngrams_search(self, ngrams):
-        c = self.db.cursor()
-        is_first = True
+        c = self._reader().cursor()
+        sets = []
         for term in ngrams:
-            cands = c.execute("SELECT document_id FROM postings WHERE term=?", (term,)).fetchall()
+            cands = c.execute("SELECT DISTINCT document_id FROM ngrams WHERE term=?", (term,)).fetchall()
             if len(cands) == 0: continue
 
-            temptitles = set(map(lambda c:c[0], cands))
-            if is_first:
-                titles = temptitles
-                is_first = False
-            else:
-                titles = titles & temptitles
-            return titles
+            sets.append(set(map(lambda c:c[0], cands)))
+        if len(sets) == 0:
+            return set()
+        sorted_sets = sorted(sets, key=len)
+        return set.intersection(*sorted_sets)
+
+    def fts_search(self, terms, limit=None, match_all=True):
+        """Finds documents for the terms using the postings_fts table built by generate(fts=True).
+
+        Terms are matched exactly, as in search(): each one is stored and queried as a single
+        hex token, so the FTS tokenizer never splits or case-folds it.
+
+        Args:
+            limit (int): Maximum number of ids to return, or None for all of them.
+            match_all (bool): Require every term (like search()) instead of any of them.
+
+        Returns:
+            List[str]: Matching document ids, best bm25 match first.
+        """
+        c = self._reader().cursor()
+        terms = list(set(terms))
+        if len(terms) == 0:
+            return []
+        query = (" AND " if match_all else " OR ").join(_fts_token(term) for term in terms)
+        c.execute("SELECT doc_id FROM postings_fts WHERE postings_fts MATCH ? ORDER BY bm25(postings_fts) LIMIT ?", (query, -1 if limit is None else limit))
+        return [doc_id for (doc_id,) in c]
+
+    def ftsSortSearch(self, terms):
+        """bm25 counterpart of sortSearch: the best document containing any of the terms, or ''.
+        """
+        titles = self.fts_search(terms, limit=1, match_all=False)
+        return titles[0] if len(titles) > 0 else ''
 
     def sortSearchReturnTable(self, terms):
-        c = self.db.cursor()
+        c = self._reader().cursor()
 
         documentVectors = {}
         defaultVector = []
         for n, term in enumerate(terms):
-            cands = c.execute("SELECT document_id FROM postings WHERE term=?", (term,)).fetchall()
+            cands = c.execute("SELECT DISTINCT document_id FROM postings WHERE term=?", (term,)).fetchall()
             if cands == None or len(cands) == 0:
                 defaultVector.append(0)
                 continue
@@ -277,7 +460,7 @@ class Index():
 
         return returnTable
 
-    def generate(self):
+    def generate(self, fts=False):
         # indexing process
         c = self.db.cursor()
         c.execute("""CREATE TABLE IF NOT EXISTS postings (
@@ -285,25 +468,38 @@ class Index():
             document_id TEXT NOT NULL,
             times INTEGER
         );""")
-        parser = natto.MeCab()
-        articles = self.collection.get_all_documents()
-        for article in articles:
-
-            dict = {}
-            for node in parser.parse(article.text(), as_nodes=True):
-                if node.is_nor():
-                    features = node.feature.split(',')
-                    term = features[6] if len(features) == 9 else node.surface
-                    if FilterWords.shouldBeIncluded(features):
-                        if term in dict:
-                            dict[term] += 1
-                        else:
-                            dict[term] = 1
-            for term in dict.keys():
-                c.execute("INSERT INTO postings VALUES(?, ?, ?)", (term, article.id(), dict[term],))
-
+        if fts:
+            # full-text alternative to postings: one row per article with its filtered terms, see fts_search()
+            c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS postings_fts USING fts5(
+                doc_id UNINDEXED,
+                text,
+                tokenize='unicode61'
+            );""")
+        c.execute("DROP INDEX IF EXISTS termindexs;")
+        c.execute("BEGIN")
+        # MeCab parsing runs in worker processes; this process only writes to SQLite
+        articles = ((title, text) for title, text, opening_text in self.collection.iter_text_only())
+        BATCH_SIZE = 32
+        batches = iter(lambda: list(itertools.islice(articles, BATCH_SIZE)), [])
+        workers = os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            # keep a bounded number of batches in flight, topping up before each insert
+            pending = collections.deque(executor.submit(_parse_articles, batch) for batch in itertools.islice(batches, workers * 4))
+            while len(pending) > 0:
+                results = pending.popleft().result()
+                for batch in itertools.islice(batches, 1):
+                    pending.append(executor.submit(_parse_articles, batch))
+                for title, dict in results:
+                    c.executemany("INSERT INTO postings VALUES(?, ?, ?)", ((term, title, times) for term, times in dict.items()))
+                    if fts:
+                        # repeat each term by its count so bm25 sees the term frequency
+                        text_for_fts = " ".join(_fts_token(term) for term, times in dict.items() for _ in range(times))
+                        c.execute("INSERT INTO postings_fts(doc_id, text) VALUES(?, ?)", (title, text_for_fts))
+
+        # build the index once after all rows are inserted
         c.execute("""CREATE INDEX IF NOT EXISTS termindexs ON postings(term, document_id);""")
-        self.db.commit()
+        c.execute("ANALYZE postings;")
+        c.execute("COMMIT")
 
     def generateFromOpeningText(self):
         # indexing process
@@ -313,51 +509,54 @@ class Index():
             document_id TEXT NOT NULL,
             times INTEGER
         );""")
+        c.execute("DROP INDEX IF EXISTS termindexs;")
+        c.execute("BEGIN")
         parser = natto.MeCab()
-        articles = self.collection.get_all_documents()
+        articles = self.collection.iter_text_only()
         count = 0
-        for article in articles:
+        for title, text, opening_text in articles:
             count += 1
             if count > 100:
                 break
 
-            dict = {}
-            for node in parser.parse(article.opening_text, as_nodes=True):
-                if node.is_nor():
-                    features = node.feature.split(',')
-                    term = features[6] if len(features) == 9 else node.surface
-                    if FilterWords.shouldBeIncluded(features):
-                        if term in dict:
-                            dict[term] += 1
-                        else:
-                            dict[term] = 1
-            for term in dict.keys():
-                c.execute("INSERT INTO postings VALUES(?, ?, ?)", (term, article.id(), dict[term],))
+            dict = _count_terms(parser, opening_text)
+            c.executemany("INSERT INTO postings VALUES(?, ?, ?)", ((term, title, times) for term, times in dict.items()))
 
+        # build the index once after all rows are inserted
         c.execute("""CREATE INDEX IF NOT EXISTS termindexs ON postings(term, document_id);""")
-        self.db.commit()
+        c.execute("ANALYZE postings;")
+        c.execute("COMMIT")
     
     def generate_ngrams(self):
         c = self.db.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS ngrams (
-            term TEXT NOT NULL,
+        # rebuild from scratch: an older TEXT-declared table would keep its affinity and rows (and its index)
+        c.execute("DROP TABLE IF EXISTS ngrams;")
+        c.execute("""CREATE TABLE ngrams (
+            term INTEGER NOT NULL,
             document_id TEXT NOT NULL
         );""")
-        articles = self.collection.get_all_documents()
+        articles = self.collection.iter_text_only()
         count = 0
         analyse = AnalyseQuery()
 
-        for article in articles:
+        BLOCK_SIZE = 10000
+        ngrams_titles = []
+        c.execute("BEGIN")
+        for title, text, opening_text in articles:
             count += 1
             if count > 100: break
 
-            ngrams = analyse.divide_ngrams(article.text())
-            ngrams_titles = [(ngram, article.id()) for ngram in ngrams]
-            c.executemany("INSERT INTO ngrams(term, document_id) VALUES(?, ?)", ngrams_titles)
-
+            ngrams = analyse.divide_ngrams(text)
+            ngrams_titles += [(ngram, title) for ngram in ngrams]
+            if len(ngrams_titles) >= BLOCK_SIZE:
+                c.executemany("INSERT INTO ngrams(term, document_id) VALUES(?, ?)", ngrams_titles)
+                ngrams_titles = []
+        c.executemany("INSERT INTO ngrams(term, document_id) VALUES(?, ?)", ngrams_titles)
 
-        c.execute("""CREATE INDEX IF NOT EXISTS termindexs ON ngrams(term, document_id);""")
-        self.db.commit()
+        # termindexs belongs to postings, so the ngrams index gets its own name
+        c.execute("""CREATE INDEX IF NOT EXISTS ngramindexs ON ngrams(term, document_id);""")
+        c.execute("ANALYZE ngrams;")
+        c.execute("COMMIT")
 
 
 
@@ -382,9 +581,9 @@ class WikipediaCollection(Collection):
             row[0], # title
             row[1], # text
             row[2], # opening_text
-            json.loads(row[3]), # auxiliary_text
-            json.loads(row[4]), # categories
-            json.loads(row[5]), # headings
+            row[3], # auxiliary_text
+            row[4], # categories
+            row[5], # headings
             row[6], # wiki_text
             row[7], # popularity_score
             row[8], # num_incoming_links
@@ -405,9 +604,9 @@ class WikipediaCollection(Collection):
         return WikipediaArticle(self, doc_id,
             row[0], # text
             row[1], # opening_text
-            json.loads(row[2]), # auxiliary_text
-            json.loads(row[3]), # categories
-            json.loads(row[4]), # headings
+            row[2], # auxiliary_text
+            row[3], # categories
+            row[4], # headings
             row[5], # wiki_text
             row[6], # popularity_score
             row[7], # num_incoming_links
@@ -445,11 +644,27 @@ class WikipediaCollection(Collection):
                     row[0], # title
                     row[1], # text
                     row[2], # opening_text
-                    json.loads(row[3]), # auxiliary_text
-                    json.loads(row[4]), # categories
-                    json.loads(row[5]), # headings
+                    row[3], # auxiliary_text
+                    row[4], # categories
+                    row[5], # headings
                     row[6], # wiki_text
                     row[7], # popularity_score
                     row[8], # num_incoming_links
 		)
 
+    def iter_text_only(self):
+        """Creates an iterator over the title and text columns only, skipping the JSON fields.
+
+        Used for indexing, where WikipediaArticle objects and their parsed lists are not needed.
+
+        Returns:
+            Iterable[Tuple[str, str, str]]: (title, text, opening_text) for every article.
+        """
+        c = self.db.cursor()
+        c.execute("SELECT title, text, opening_text FROM articles")
+        BLOCK_SIZE = 1000
+        while True:
+            block = c.fetchmany(BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            yield from block